@@ -1,5 +1,6 @@
 import tracecmd
 import struct
+from collections import OrderedDict
 
 
 # Default amount of padding to add to the left of strings being printed
@@ -105,13 +106,235 @@ def precenq_event_handler(pevent, trace_seq, event):
         trace_puts(trace_seq, "%s %2d: %d\n" % ("prec", i, pmax[i]))
 
 
+# Bitfields of the txstatus frameid and status words, as (start, length)
+TXFID_QUEUE = (0, 3)
+TXFID_RATE = (3, 2)
+TXFID_SEQ = (5, 11)
+
+TX_STATUS_VALID = (0, 1)
+TX_STATUS_ACK_RCV = (1, 1)
+TX_STATUS_SUPR = (2, 3)
+TX_STATUS_AMPDU = (5, 1)
+TX_STATUS_INTERMEDIATE = (6, 1)
+TX_STATUS_PMINDCTD = (7, 1)
+TX_STATUS_RTS_RTX = (8, 4)
+TX_STATUS_FRM_RTX = (12, 4)
+
+frameid_descs = [
+    TXFID_QUEUE + ("TXFID_QUEUE", "Tx queue"),
+    TXFID_RATE + ("TXFID_RATE", "Tx rate"),
+    TXFID_SEQ + ("TXFID_SEQ", "Tx sequence"),
+]
+txstat_descs = [
+    TX_STATUS_VALID + ("TX_STATUS_VALID", "Tx status valid"),
+    TX_STATUS_ACK_RCV + ("TX_STATUS_ACK_RCV", "ACK received"),
+    TX_STATUS_SUPR + ("TX_STATUS_SUPR", "Suppress status"),
+    TX_STATUS_AMPDU + ("TX_STATUS_AMPDU", "AMPDU status"),
+    TX_STATUS_INTERMEDIATE + ("TX_STATUS_INTERMEDIATE", "Intermediate or 1st ampdu pkg"),
+    TX_STATUS_PMINDCTD + ("TX_STATUS_PMINDCTD", "PM mode indicated to AP"),
+    TX_STATUS_RTS_RTX + ("TX_STATUS_RTS_RTX", "RTS count"),
+    TX_STATUS_FRM_RTX + ("TX_STATUS_FRM_RTX", "Frame count"),
+]
+
+# AMPDU position of a frame in the MacTxControlLow word of the txdesc
+TXC_AMPDU = (9, 2)
+TXC_AMPDU_FIRST = 1
+TXC_AMPDU_MIDDLE = 2
+TXC_AMPDU_LAST = 3
+
+# Raw txdesc layout, and the words the join engine needs from it
+TXDESC_FMT = "<11H16B6BH6BH6B14H6B2H6B6BH"
+TXH_MACTXCONTROLLOW = 0
+TXH_TXFRAMEID = 55
+
+def get_field(bf, field):
+    (start, length) = field
+    return (bf >> start) & ((1 << length) - 1)
+
+# Latency histogram buckets, in microseconds. The last bucket is open
+# ended.
+LAT_BUCKETS = [64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768]
+
+class TxRateStats:
+    def __init__(self):
+        self.status = 0
+        self.mpdus = 0
+        self.ampdu_mpdus = 0
+        self.suppressed = 0
+        self.noack = 0
+        self.frm_rtx = 0
+        self.rts_rtx = 0
+        self.lat_total = 0
+        self.lat_min = None
+        self.lat_max = 0
+        self.hist = [0] * (len(LAT_BUCKETS) + 1)
+
+    def add(self, status, mpdus, lat):
+        self.status += 1
+        self.mpdus += mpdus
+        if get_field(status, TX_STATUS_AMPDU):
+            self.ampdu_mpdus += mpdus
+        if not get_field(status, TX_STATUS_ACK_RCV):
+            self.noack += 1
+        # The count fields include the first transmission
+        self.rts_rtx += max(get_field(status, TX_STATUS_RTS_RTX) - 1, 0)
+        self.frm_rtx += max(get_field(status, TX_STATUS_FRM_RTX) - 1, 0)
+        self.lat_total += lat
+        if self.lat_min is None or lat < self.lat_min:
+            self.lat_min = lat
+        if lat > self.lat_max:
+            self.lat_max = lat
+        for i in range(len(LAT_BUCKETS)):
+            if lat < LAT_BUCKETS[i]:
+                self.hist[i] += 1
+                break
+        else:
+            self.hist[-1] += 1
+
+class TxDesc:
+    def __init__(self, ts, ampdu):
+        self.ts = ts
+        self.ampdu = ampdu
+        self.tails = []
+
+# Joins outgoing txdescs to their txstatus by (dev, frameid); the frameid
+# includes the tx queue. Descriptors without a status are evicted oldest
+# first beyond max_pending. AMPDU middle/last descriptors are retired with
+# the status of the preceding AMPDU first descriptor on the same queue.
+class TxJoin:
+    def __init__(self, max_pending=4096):
+        self.max_pending = max_pending
+        self.pending = OrderedDict()
+        self.agg_head = {}
+        self.stats = {}
+        self.evicted = 0
+        self.evicted_tails = 0
+        self.unmatched = 0
+        self.invalid = 0
+        self.intermediate = 0
+
+    def evict(self, desc):
+        if desc.ampdu in (TXC_AMPDU_MIDDLE, TXC_AMPDU_LAST):
+            self.evicted_tails += 1
+        else:
+            self.evicted += 1
+
+    def desc(self, dev, frameid, ctl_low, ts):
+        key = (dev, frameid)
+        ampdu = get_field(ctl_low, TXC_AMPDU)
+        # A reused frameid supersedes the stale descriptor
+        if key in self.pending:
+            self.evict(self.pending.pop(key))
+        elif len(self.pending) >= self.max_pending:
+            self.evict(self.pending.popitem(last=False)[1])
+        self.pending[key] = TxDesc(ts, ampdu)
+
+        agg = (dev, get_field(frameid, TXFID_QUEUE))
+        if ampdu == TXC_AMPDU_FIRST:
+            self.agg_head[agg] = key
+        elif ampdu in (TXC_AMPDU_MIDDLE, TXC_AMPDU_LAST):
+            head = self.pending.get(self.agg_head.get(agg))
+            if head is not None:
+                head.tails.append(key)
+            if ampdu == TXC_AMPDU_LAST:
+                self.agg_head.pop(agg, None)
+        else:
+            self.agg_head.pop(agg, None)
+
+    # Returns the descriptor-to-status latency in microseconds, or None
+    # if the status was not joined to a transmitted frame.
+    def status(self, dev, frameid, status, ts):
+        if not get_field(status, TX_STATUS_VALID):
+            self.invalid += 1
+            return None
+        # Like the driver, ignore intermediate non-AMPDU statuses
+        if (get_field(status, TX_STATUS_INTERMEDIATE) and
+                not get_field(status, TX_STATUS_AMPDU)):
+            self.intermediate += 1
+            return None
+        desc = self.pending.pop((dev, frameid), None)
+        if desc is None:
+            self.unmatched += 1
+            return None
+        mpdus = 1
+        for tail in desc.tails:
+            if self.pending.pop(tail, None) is not None:
+                mpdus += 1
+
+        key = (dev, get_field(frameid, TXFID_QUEUE),
+               get_field(frameid, TXFID_RATE))
+        if key not in self.stats:
+            self.stats[key] = TxRateStats()
+        if get_field(status, TX_STATUS_SUPR):
+            self.stats[key].suppressed += 1
+            return None
+        lat = (ts - desc.ts) // 1000
+        self.stats[key].add(status, mpdus, lat)
+        return lat
+
+    def report(self, out):
+        out.write("brcmsmac tx descriptor-to-status latency (us):\n")
+        out.write("%-12s %5s %4s %8s %8s %6s %7s %6s %7s %6s %7s %6s %8s %8s %8s\n" %
+                  ("dev", "queue", "rate", "status", "mpdus", "supr",
+                   "noack%", "ampdu%", "frmrtx", "/st", "rtsrtx", "/st",
+                   "avg", "min", "max"))
+        for key in sorted(self.stats):
+            (dev, queue, rate) = key
+            s = self.stats[key]
+            if s.status == 0:
+                out.write("%-12s %5d %4d %8d %8d %6d\n" %
+                          (dev, queue, rate, 0, 0, s.suppressed))
+                continue
+            out.write("%-12s %5d %4d %8d %8d %6d %7.2f %6.2f %7d %6.2f %7d %6.2f %8d %8d %8d\n" %
+                      (dev, queue, rate, s.status, s.mpdus, s.suppressed,
+                       100.0 * s.noack / s.status,
+                       100.0 * s.ampdu_mpdus / s.mpdus,
+                       s.frm_rtx, float(s.frm_rtx) / s.status,
+                       s.rts_rtx, float(s.rts_rtx) / s.status,
+                       s.lat_total // s.status, s.lat_min, s.lat_max))
+        for key in sorted(self.stats):
+            (dev, queue, rate) = key
+            s = self.stats[key]
+            if s.status == 0:
+                continue
+            out.write("\n[%s] queue %d rate %d latency histogram:\n" %
+                      (dev, queue, rate))
+            lo = 0
+            for i in range(len(s.hist)):
+                if i < len(LAT_BUCKETS):
+                    label = "%d-%d" % (lo, LAT_BUCKETS[i] - 1)
+                    lo = LAT_BUCKETS[i]
+                else:
+                    label = ">=%d" % lo
+                out.write("  %12s us: %d\n" % (label, s.hist[i]))
+        out.write("\npending %d evicted %d evicted ampdu tails %d unmatched status %d invalid status %d intermediate status %d\n" %
+                  (len(self.pending), self.evicted, self.evicted_tails,
+                   self.unmatched, self.invalid, self.intermediate))
+
+# The plugin only prints the per-frame latency; the summary comes from
+# brcmsmac_txlat.py. Events may be formatted more than once, so each
+# record (by file offset) is joined once and its result remembered.
+txjoin = TxJoin()
+txjoin_seen = OrderedDict()
+
+def txjoin_once(event, join):
+    offset = event._record.offset
+    if offset in txjoin_seen:
+        return txjoin_seen[offset]
+    res = join()
+    if len(txjoin_seen) >= 2 * txjoin.max_pending:
+        txjoin_seen.popitem(last=False)
+    txjoin_seen[offset] = res
+    return res
+
+
 def txdesc_event_handler(pevent, trace_seq, event):
     if long(event['in']) == 1:
         txdir = "IN"
     else:
         txdir = "OUT"
     # txdesc is supplied in the raw binary format. Unpack the data.
-    txh = struct.unpack("<11H16B6BH6BH6B14H6B2H6B6BH", event['txh'].data)
+    txh = struct.unpack(TXDESC_FMT, event['txh'].data)
     trace_seq.puts("%s[%s] txdesc:\n" % (txdir, str(event['dev'])))
     trace_puts(trace_seq, "%-30s %#x\n" % ("MacTxControlLow", txh[0]))
     trace_puts(trace_seq, "%-30s %#x\n" % ("MacTxControlHigh", txh[1]))
@@ -158,24 +381,14 @@ def txdesc_event_handler(pevent, trace_seq, event):
     dump_hex(trace_seq, 2, txh[75:81])
     # Final element is pad byte
 
+    if txdir == "OUT":
+        txjoin_once(event, lambda: txjoin.desc(str(event['dev']),
+                                               txh[TXH_TXFRAMEID],
+                                               txh[TXH_MACTXCONTROLLOW],
+                                               event.ts))
 
-def txstatus_event_handler(pevent, trace_seq, event):
-    frameid_descs = [
-        [0, 3, "TXFID_QUEUE", "Tx queue"],
-        [3, 2, "TXFID_RATE", "Tx rate"],
-        [5, 11, "TXFID_SEQ", "Tx sequence"],
-    ]
-    txstat_descs = [
-        [0,  1, "TX_STATUS_VALID", "Tx status valid"],
-        [1,  1, "TX_STATUS_ACK_RCV", "ACK received"],
-        [2,  3, "TX_STATUS_SUPR", "Suppress status"],
-        [5,  1, "TX_STATUS_AMPDU", "AMPDU status"],
-        [6,  1, "TX_STATUS_INTERMEDIATE", "Intermediate or 1st ampdu pkg"],
-        [7,  1, "TX_STATUS_PMINDCTD", "PM mode indicated to AP"],
-        [8,  4, "TX_STATUS_RTS_RTX", "RTS count"],
-        [12, 4, "TX_STATUS_FRM_RTX", "Frame count"],
-    ]
 
+def txstatus_event_handler(pevent, trace_seq, event):
     framelen = long(event['framelen'])
     frameid = long(event['frameid'])
     status = long(event['status'])
@@ -193,6 +406,11 @@ def txstatus_event_handler(pevent, trace_seq, event):
     trace_puts(trace_seq, "tx status:\n")
     print_bitfield(trace_seq, 2, status, txstat_descs)
 
+    lat = txjoin_once(event, lambda: txjoin.status(str(event['dev']), frameid,
+                                                   status, event.ts))
+    if lat is not None:
+        trace_puts(trace_seq, "%-30s %d us\n" % ("desc-to-status latency", lat))
+
 
 def register(pevent):
     pevent.register_event_handler("brcmsmac", "brcms_macintstatus",
@@ -203,3 +421,53 @@ def register(pevent):
             lambda *args: txstatus_event_handler(pevent, *args))
     pevent.register_event_handler("brcmsmac_tx", "brcms_txdesc",
             lambda *args: txdesc_event_handler(pevent, *args))
+
+if __name__ == "__main__":
+	import sys
+	F = TXC_AMPDU_FIRST << TXC_AMPDU[0]
+	M = TXC_AMPDU_MIDDLE << TXC_AMPDU[0]
+	L = TXC_AMPDU_LAST << TXC_AMPDU[0]
+
+	print('testing: retries')
+	j = TxJoin()
+	j.desc("wlan0", 0x31, 0, 1000000)
+	assert j.status("wlan0", 0x31, 0x3003, 1500000) == 500
+	s = j.stats[("wlan0", 1, 2)]
+	assert (s.frm_rtx, s.rts_rtx, s.noack) == (2, 0, 0)
+
+	print('testing: intermediate status')
+	j = TxJoin()
+	j.desc("wlan0", 0x31, 0, 1000000)
+	assert j.status("wlan0", 0x31, 0x41, 1100000) is None
+	assert j.status("wlan0", 0x31, 0x1003, 1400000) == 400
+	assert (j.intermediate, j.unmatched, j.stats[("wlan0", 1, 2)].noack) == (1, 0, 0)
+
+	print('testing: suppressed and invalid status')
+	j = TxJoin()
+	j.desc("wlan0", 0x31, 0, 1000000)
+	j.desc("wlan0", 0x39, 0, 1000000)
+	assert j.status("wlan0", 0x31, 0x0009, 1100000) is None
+	assert j.status("wlan0", 0x39, 0x0002, 1100000) is None
+	s = j.stats[("wlan0", 1, 2)]
+	assert (s.suppressed, s.status, j.invalid, len(j.pending)) == (1, 0, 1, 1)
+
+	print('testing: ampdu')
+	j = TxJoin()
+	j.desc("wlan0", 0x29, F, 1000000)
+	j.desc("wlan0", 0x49, M, 1000100)
+	j.desc("wlan0", 0x69, L, 1000200)
+	j.desc("wlan0", 0x89, 0, 1000300)
+	assert j.status("wlan0", 0x29, 0x1023, 2000000) == 1000
+	assert j.status("wlan0", 0x89, 0x1003, 2000000) == 999
+	s = j.stats[("wlan0", 1, 1)]
+	assert (s.status, s.mpdus, s.ampdu_mpdus, len(j.pending)) == (2, 4, 3, 0)
+
+	print('testing: eviction')
+	j = TxJoin(max_pending=2)
+	j.desc("wlan0", 0x29, F, 1000000)
+	j.desc("wlan0", 0x49, L, 1000100)
+	j.desc("wlan0", 0x31, 0, 1000200)
+	j.desc("wlan0", 0x39, 0, 1000300)
+	assert (j.evicted, j.evicted_tails) == (1, 1)
+
+	j.report(sys.stdout)
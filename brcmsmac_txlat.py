@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+#
+# Per queue and rate tx latency report for brcmsmac. Joins the
+# brcms_txdesc and brcms_txstatus events of a trace.dat file (see TxJoin
+# in brcmsmac.py) and prints the summary once all events are read.
+#
+# This is a standalone script, not a trace-cmd plugin:
+#
+#   brcmsmac_txlat.py [trace.dat]
+
+import sys
+import struct
+import tracecmd
+import brcmsmac
+
+
+def main(argv):
+    if len(argv) > 1:
+        filename = argv[1]
+    else:
+        filename = "trace.dat"
+    trace = tracecmd.Trace(filename)
+    txjoin = brcmsmac.TxJoin()
+
+    while True:
+        event = trace.read_next_event()
+        if event is None:
+            break
+        if event.name == "brcms_txdesc":
+            if long(event['in']) == 1:
+                continue
+            txh = struct.unpack(brcmsmac.TXDESC_FMT, event['txh'].data)
+            txjoin.desc(str(event['dev']), txh[brcmsmac.TXH_TXFRAMEID],
+                        txh[brcmsmac.TXH_MACTXCONTROLLOW], event.ts)
+        elif event.name == "brcms_txstatus":
+            txjoin.status(str(event['dev']), long(event['frameid']),
+                          long(event['status']), event.ts)
+
+    txjoin.report(sys.stdout)
+
+if __name__ == "__main__":
+    main(sys.argv)